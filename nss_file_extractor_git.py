@@ -1,103 +1,270 @@
 import os
-import re
-import chardet
+import codecs
+import mmap
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 import json
 
+try:
+    import cchardet as chardet
+except ImportError:
+    import chardet
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 INPUT_FOLDER = "folder/with/nss/files"
 OUTPUT_FOLDER = "folder/for/nss/json/output"
+ERROR_LOG_FILE = "errors.txt"
 
+# Only this many leading bytes are handed to the encoding detector.
+ENCODING_SAMPLE_SIZE = 65536
 
-def detect_encoding(file_path):
-    """Detect the file encoding."""
-    with open(file_path, 'rb') as f:
-        result = chardet.detect(f.read())
-        return result['encoding']
-    
+BOM_ENCODINGS = (
+    (b'\xef\xbb\xbf', 'utf-8-sig'),
+    (b'\xff\xfe', 'utf-16'),
+    (b'\xfe\xff', 'utf-16'),
+)
 
-def extract_pre_content(file_path):
+
+# Encodings tried before falling back to chardet, NSS files are usually one of these.
+COMMON_ENCODINGS = ('utf-8', 'shift_jis', 'cp932')
+
+# Files of the same game tend to share an encoding, so the last non utf-8 one found
+# is tried right after utf-8.
+last_detected_encoding = 'utf-8'
+
+
+def decodes_as(sample, encoding):
+    """Whether the sample decodes, ignoring a multi-byte character cut off at its end."""
     try:
-        with open(file_path, 'r', encoding=detect_encoding(file_path)) as file:
-            content = file.read()
+        codecs.getincrementaldecoder(encoding)().decode(sample, final=False)
+        return True
+    except UnicodeDecodeError:
+        return False
+
+
+def sniff_encoding(sample):
+    """
+    Detect the encoding of a byte sample, using the BOM when there is one,
+    then trying utf-8, the last detected and common encodings, and only then chardet.
+    """
+    global last_detected_encoding
+
+    for bom, encoding in BOM_ENCODINGS:
+        if sample.startswith(bom):
+            return encoding
+
+    # ISO-2022 encodings (e.g. ISO-2022-JP) are 7-bit and would pass as utf-8,
+    # their escape sequences are left for chardet to recognise.
+    if b'\x1b' not in sample:
+        # utf-8 goes first, short utf-8 text often also decodes as shift_jis/cp932,
+        # while utf-8 validation fails within a few bytes on anything else.
+        for encoding in dict.fromkeys(('utf-8', last_detected_encoding) + COMMON_ENCODINGS):
+            if decodes_as(sample, encoding):
+                if encoding != 'utf-8':
+                    last_detected_encoding = encoding
+                return encoding
+
+    return chardet.detect(sample)['encoding']
+
+
+def find_pre_blocks(content):
+    """
+    Returns the content of every <PRE ...></PRE> block, scanning forward with find()
+    instead of a backtracking regex. Works on str as well as on bytes or an mmap.
+    """
+    if isinstance(content, str):
+        open_tag, tag_close, close_tag = '<PRE', '>', '</PRE>'
+    else:
+        open_tag, tag_close, close_tag = b'<PRE', b'>', b'</PRE>'
+
+    pre_contents = []
+    i = 0
+    while True:
+        start = content.find(open_tag, i)
+        if start < 0:
+            break
+        tag_end = content.find(tag_close, start)
+        if tag_end < 0:
+            break
+        end = content.find(close_tag, tag_end + 1)
+        if end < 0:
+            break
+        pre_contents.append(content[tag_end + 1:end])
+        i = end + len(close_tag)
+    return pre_contents
+
 
-        # Use a regular expression to find all content within <PRE></PRE> tags
-        pre_contents = re.findall(r'<PRE.*?>(.*?)</PRE>', content, re.DOTALL)
+def is_ascii_compatible(encoding):
+    """Whether the ASCII tags can be searched for directly in bytes of this encoding."""
+    return not codecs.lookup(encoding).name.startswith(('utf-16', 'utf-32', 'iso2022'))
 
-        return pre_contents
-    except:
-        return "<Encoding Error>"
+
+def extract_pre_content(file_path):
+    """
+    Returns the content of every <PRE></PRE> block in the file, or an empty list
+    if the file cannot be read or decoded, in which case the error is logged to ERROR_LOG_FILE.
+    """
+    try:
+        with open(file_path, 'rb') as file:
+            if os.fstat(file.fileno()).st_size == 0:
+                return []
+
+            # Map the file instead of reading it, detect the encoding from its head,
+            # and only decode the content within <PRE></PRE> tags.
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                encoding = sniff_encoding(mm[:ENCODING_SAMPLE_SIZE])
+                if encoding is None:
+                    raise LookupError("unable to detect the encoding")
+                if is_ascii_compatible(encoding):
+                    return [block.decode(encoding, errors='replace') for block in find_pre_blocks(mm)]
+                return find_pre_blocks(mm[:].decode(encoding, errors='replace'))
+    except (OSError, UnicodeDecodeError, LookupError) as e:
+        print(f"Error reading {file_path}: {e}")
+        with open(ERROR_LOG_FILE, 'a', encoding='utf-8') as error_file:
+            error_file.write(f"{file_path}: {e}\n")
+        return []
     
 
+def dumps_json_bytes(obj, indent=True):
+    """
+    Serialize an object to UTF-8 JSON bytes, using orjson when it is installed.
+    With indent=False the output is compact, with no whitespace at all.
+    """
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else None)
+    if indent:
+        return json.dumps(obj, ensure_ascii=False, indent=2).encode('utf-8')
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
 def save_content_to_json(content, json_path):
-    """Save extracted content to a JSON file."""
+    """Save extracted content to a JSON file, compact since it is only read by the translator."""
     try:
-        with open(json_path, 'w', encoding='utf-8') as json_file:
-            json.dump({"content": process_content(content)}, json_file, ensure_ascii=False, indent=4)
+        with open(json_path, 'wb') as json_file:
+            json_file.write(dumps_json_bytes({"content": process_content(content)}, indent=False))
         print(f"Content saved to {json_path}")
     except Exception as e:
         print(f"Error saving content to {json_path}: {e}")
 
 def process_content(content: list[str]):
+    """
+    Parses each <PRE> block into a single level dict of parallel lists:
+    {"text label": str, "Name": [str | None], "voice tag": [str | None], "text": [str]}
+    The i-th Name and voice tag belong to the i-th text, which can span several lines.
+    """
     processed = []
 
     for entry in content:
         # Find all <text label> sections
         lines = entry.splitlines()
 
-        ele = {
-            "text label": None,
-            "Name": [],
-            "voice tag": [],
-            "text": [],
-        }
+        text_label = None
+        names = []
+        voice_tags = []
+        texts = []
+        # List lengths are tracked alongside the appends instead of calling len() per line.
+        name_len = voice_len = text_len = 0
+        # Each text is kept as a list of its lines, joined once the entry is parsed, and whether
+        # the last one contains "」" is tracked from its lines, so neither is rescanned per line.
+        last_text_closed = False
 
         # JSON parsing logic, specific to NSS files of certain format
         # Will require changes
+        # The markers can appear anywhere in a line and are checked in priority order, plain
+        # substring checks do that faster than a single regex with an alternative per marker.
         for line in lines:
-            if line != "":
-                if "[text" in line:
-                    ele["text label"] = line
-                elif "「" in line:
-                    if len(ele["Name"]) != len(ele["text"]) + 1:
-                        ele["Name"].append(None)
-                    if len(ele["voice tag"]) != len(ele["text"]) + 1:
-                        ele["voice tag"].append(None)
-                    ele["text"].append(line)
-                elif "【" in line:
-                    ele["Name"].append(line)
-                elif "<voice" in line:
-                    if len(ele["Name"]) != len(ele["voice tag"]) + 1:
-                        ele["Name"].append(None)
-                    ele["voice tag"].append(line)
-                else:
-                    if len(ele["text"]) == 0:
-                        ele["text"].append(line)
-                    elif ele["text"] and "」" in ele["text"][-1]:
-                        if len(ele["Name"]) != len(ele["text"]) + 1:
-                            ele["Name"].append(None)
-                        if len(ele["voice tag"]) != len(ele["text"]) + 1:
-                            ele["voice tag"].append(None)
-                        ele["text"].append(line)
-                    else:
-                        ele["text"][-1] = ele["text"][-1] + "\n" + line
+            if not line:
+                continue
+            if "[text" in line:
+                text_label = line
+            elif "「" in line:
+                if name_len != text_len + 1:
+                    names.append(None)
+                    name_len += 1
+                if voice_len != text_len + 1:
+                    voice_tags.append(None)
+                    voice_len += 1
+                texts.append([line])
+                text_len += 1
+                last_text_closed = "」" in line
+            elif "【" in line:
+                names.append(line)
+                name_len += 1
+            elif "<voice" in line:
+                if name_len != voice_len + 1:
+                    names.append(None)
+                    name_len += 1
+                voice_tags.append(line)
+                voice_len += 1
+            elif text_len == 0:
+                texts.append([line])
+                text_len += 1
+                last_text_closed = "」" in line
+            elif last_text_closed:
+                if name_len != text_len + 1:
+                    names.append(None)
+                    name_len += 1
+                if voice_len != text_len + 1:
+                    voice_tags.append(None)
+                    voice_len += 1
+                texts.append([line])
+                text_len += 1
+                last_text_closed = "」" in line
+            else:
+                texts[-1].append(line)
+                last_text_closed = "」" in line
 
+        ele = {
+            "text label": text_label,
+            "Name": names,
+            "voice tag": voice_tags,
+            "text": ["\n".join(text_lines) for text_lines in texts],
+        }
         processed.append(ele)
         
     return processed
 
-def process_folder(folder_path, out_path):
-    """Iterates through all files in the folder and extracts <PRE></PRE> content."""
-    for root, _, files in os.walk(folder_path):
-        for file_name in files:
-            file_path = os.path.join(root, file_name)
-            print(f"Processing file: {file_path}")
-            pre_contents = extract_pre_content(file_path)
-                
-            if pre_contents:
-                # Construct the path for the output JSON file (same name, .json extension)
-                json_path = os.path.splitext(os.path.join(out_path, file_name))[0] + '.json'
-                
-                # Save extracted content to the JSON file
-                save_content_to_json(pre_contents, json_path)
+def iter_files(folder_path):
+    """Recursively yields the os.DirEntry of every file under the folder, symlinked folders are not followed."""
+    # Like os.walk, folders that cannot be listed are skipped.
+    try:
+        entries = os.scandir(folder_path)
+    except OSError:
+        return
+    with entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                yield from iter_files(entry.path)
+            elif entry.is_file():
+                yield entry
+
+def process_file(file_path, out_path):
+    """Extracts the <PRE></PRE> content of a single file and saves it as JSON in out_path."""
+    print(f"Processing file: {file_path}")
+    pre_contents = extract_pre_content(file_path)
+        
+    if pre_contents:
+        # Construct the path for the output JSON file (same name, .json extension)
+        json_path = os.path.splitext(os.path.join(out_path, os.path.basename(file_path)))[0] + '.json'
+        
+        # Save extracted content to the JSON file
+        save_content_to_json(pre_contents, json_path)
+
+def process_folder(folder_path, out_path, max_workers=None):
+    """
+    Iterates through all files in the folder and extracts <PRE></PRE> content.
+    Files are independent, so they are processed in parallel across max_workers processes
+    (defaults to the number of CPUs).
+    """
+    file_paths = [entry.path for entry in iter_files(folder_path)]
+
+    with ProcessPoolExecutor(max_workers=max_workers or os.cpu_count()) as executor:
+        list(executor.map(process_file, file_paths, repeat(out_path), chunksize=8))
 
 # Example usage
-process_folder(INPUT_FOLDER, OUTPUT_FOLDER)
\ No newline at end of file
+if __name__ == "__main__":
+    process_folder(INPUT_FOLDER, OUTPUT_FOLDER)
\ No newline at end of file
@@ -1,13 +1,40 @@
+import array
+import asyncio
+import functools
 import json
+import mmap
 import tiktoken
 import ollama
 import re
 import os
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
 DORIAN = "dorian2b/vera"
 AYA_EXP = "aya-expanse"
 LLAMA_3_1 = "llama3.1"
 
+JSON_BLOCK_RE = re.compile(r'```json(.*?)```', re.DOTALL)
+# Bytes patterns, for scanning memory mapped files.
+JSON_BLOCK_RE_B = re.compile(rb'```json(.*?)```', re.DOTALL)
+TRANSLATION_RE_B = re.compile(rb'"translation":(.*?)}', re.DOTALL)
+
+
+@functools.lru_cache(maxsize=4)
+def get_tokenizer(encoding_name):
+    """
+    Returns the tiktoken encoding, built only once per encoding name.
+    """
+    return tiktoken.get_encoding(encoding_name)
+
 
 # PROMPT TEMPLATES:
 
@@ -26,23 +53,14 @@ Now translate all of this into english with above rules in mind:
 """
 
 VN_NSS_JSON_TRANSLATION_INSTRUCTION = """
-You will be given a list of jsons in the following format:
+You will be given a compact json in the following format:
 ```json
-{
-    "text": [
-        "「んなバカな！」",
-        "「そんな単純に、セカイが滅びるかッ！」"
-    ]
-}
+{"text":["「んなバカな！」","「そんな単純に、セカイが滅びるかッ！」"]}
+```
 You have to return the same json, but the values in "Name" and "text" field 
 translated to english, for the above example, this will be the output:
 ```json
-{
-    "text": [
-        "No way!",
-        "The world won't end that easily!"
-    ]
-}
+{"text":["No way!","The world won't end that easily!"]}
 ```
 Sometimes, in the "text" field, you will find <RUBY></RUBY> tag(s), like this:
 `伝説の初代<RUBY text="エトワール">魔女</RUBY>`
@@ -52,6 +70,25 @@ form will be:
 Now with above rules in mind, translate the following json:
 """
 
+VN_NSS_JSON_BATCH_TRANSLATION_INSTRUCTION = """
+You will be given a compact json array of jsons in the following format:
+```json
+[{"text":["「んなバカな！」","「そんな単純に、セカイが滅びるかッ！」"]},{"text":["「伝説の初代魔女」"]}]
+```
+You have to return a json array of the same length and in the same order, with each json 
+the same, but the values in "text" field translated to english, for the above example, 
+this will be the output:
+```json
+[{"text":["No way!","The world won't end that easily!"]},{"text":["The legendary first-generation witch"]}]
+```
+Sometimes, in the "text" field, you will find <RUBY></RUBY> tag(s), like this:
+`伝説の初代<RUBY text="エトワール">魔女</RUBY>`
+Make sure to keep the tags and translate the text, for example for above, the translated
+form will be:
+`The legendary first-generation <RUBY text="Etoile">witch</RUBY>`
+Now with above rules in mind, translate the following json array:
+"""
+
 CHECK_GLOSSARY = """
 I am going to give you a glossary,
 The keys are japanese names, and the nested json structure's 'actualname' key
@@ -130,22 +167,32 @@ class VnTranslator:
     * Save LLM response(s) to files(s)
     * Go through the response and clean the data, if required.
     """
-    def __init__(self, raw_loc, raw_glossary_loc, glossary_loc, raw_translate_loc, refined_translation_loc, summary_file):
+    def __init__(self, raw_loc, raw_glossary_loc, glossary_loc, raw_translate_loc, refined_translation_loc, summary_file, max_concurrency=4, batch_size=8):
         self.raw_loc = raw_loc # Can be any raw readable form path, nss-json folder, ln-txt file, etc
         self.raw_glossary_loc = raw_glossary_loc
         self.glossary_loc = glossary_loc
         self.raw_translate_loc = raw_translate_loc # Can be any raw translation path, nss-json folder, ln-tex file
         self.refined_translation_loc = refined_translation_loc
         self.loaded_glossary = dict()
+        self.glossary_automaton = None # Aho-Corasick automaton over the loaded glossary names, if available
         self.summary_file = summary_file
+        self.max_concurrency = max_concurrency # Max number of requests sent to the OLLAMA server at once
+        self.batch_size = batch_size # Number of nss json elements translated in a single prompt
 
     def create_raw_glossary(self):
         """
         Uses the LLM to create a name glossary for consistency during translation.
         """
+        prompts = [VnTranslator.get_instruction_prompt(NOUN_GLOSSARY_CREATION_INSTRUCTIONS, chunk)
+                   for chunk in VnTranslator.get_chunks(self.summary_file, tokens_per_chunk=400)]
+        responses = asyncio.run(self.do_with_texts(prompts, model=LLAMA_3_1))
+
         with open(self.raw_glossary_loc, 'w', encoding='utf-8') as out_file:
-            for chunk in VnTranslator.get_chunks(self.summary_file, tokens_per_chunk=400):
-                response = VnTranslator.do_with_text(VnTranslator.get_instruction_prompt(NOUN_GLOSSARY_CREATION_INSTRUCTIONS, chunk), model=LLAMA_3_1)
+            for index, response in enumerate(responses):
+                if isinstance(response, Exception):
+                    # Skip chunks whose request failed, and keep the rest.
+                    print(f"Glossary creation for chunk {index} failed: {response}")
+                    continue
                 out_file.write(response + "\n\n")
 
         print(f"Glossary creation complete, check {self.raw_glossary_loc}")
@@ -158,8 +205,8 @@ class VnTranslator:
         VnTranslator.extract_json_from_text(self.raw_glossary_loc, self.glossary_loc, "glossary_json_creation_error_logs.txt")
         processed_json_eles = []
 
-        with open(self.glossary_loc, 'r', encoding='utf-8') as file:
-            data = json.load(file)
+        with open(self.glossary_loc, 'rb') as file:
+            data = VnTranslator.loads_json(file.read())
 
             # To cache already added names.
             names_read = set()
@@ -182,8 +229,8 @@ class VnTranslator:
         """
         Loads glossary from the specified location to use later.
         """
-        with open(self.glossary_loc, 'r', encoding='utf-8') as file: 
-            data= json.load(file)
+        with open(self.glossary_loc, 'rb') as file: 
+            data = VnTranslator.loads_json(file.read())
             for ele in data:
                 self.loaded_glossary[ele["japanesename"]] = {
                     "actualname" : ele["actualname"],
@@ -191,6 +238,13 @@ class VnTranslator:
                     # "is_char" : ele["is_char"]
                 }
 
+        # Build an automaton over the names, so a chunk can be scanned for all of them in one pass.
+        if ahocorasick is not None and self.loaded_glossary:
+            self.glossary_automaton = ahocorasick.Automaton()
+            for key, value in self.loaded_glossary.items():
+                self.glossary_automaton.add_word(key, (key, value))
+            self.glossary_automaton.make_automaton()
+
     def create_raw_translation_vn_nss_json(self):
         """
         This method, reads through nss JSON files in a given folder, translates some part into english
@@ -198,49 +252,97 @@ class VnTranslator:
         """
         failure_log = []
 
-        for root, _, files in os.walk(self.raw_loc):
-            for file_name in files:
-                file_path = os.path.join(root, file_name)
-
-                print(f"Processing file: {file_path}")
-                collected_json = []
-                for index, element in enumerate(VnTranslator.read_nss_json_content(file_path)):
-
-                    if element:
-
-                        # Extract relevant portion for translation
-                        translation_json = {
-                            "text": element["text"]
-                        }
-                        # Convert into string.
-                        str_json_ele = json.dumps(translation_json, ensure_ascii=False, indent=4)
-                        # Translate
-                        response = VnTranslator.do_with_text(
-                            self.get_translate_with_glossary_prompt(str_json_ele, 
-                                                                    translation_instruction=VN_NSS_JSON_TRANSLATION_INSTRUCTION)
-                        )
-                        # Detect Json markdown using regex and extract content.
-                        json_block = re.findall(r'```json(.*?)```', response, re.DOTALL)
-                        if json_block:
-                            # Try to parse the JSON string
-                            json_data, failure = VnTranslator.loadJsonWithReTry(file_name, index, json_block[0])
-
-                            if failure:
-                                # Log if parsing failed.
-                                failure_log.append(failure)
-                            else:
-                                # Extract the data.
-                                json_data["text label"] = element["text label"]
-                                json_data["voice tag"] = element["voice tag"]
-                                json_data["Name"] = element["Name"]
-                                collected_json.append(json_data)
-                
-                file_json = {
-                    "content": collected_json
-                }
-                # Dumb translated json to given location.
-                translated_json_file_path = os.path.join(self.raw_translate_loc, file_name)
-                VnTranslator.dump_json_dic_to_json_file(translated_json_file_path, file_json)
+        for entry in VnTranslator.iter_files(self.raw_loc):
+            file_name = entry.name
+            file_path = entry.path
+
+            print(f"Processing file: {file_path}")
+            to_translate = [(index, element) for index, element in enumerate(VnTranslator.read_nss_json_content(file_path))
+                            if element]
+
+            # Translate the elements batch_size at a time, then retry the elements of any batch
+            # that could not be matched back one by one.
+            batches = [to_translate[i:i + self.batch_size] for i in range(0, len(to_translate), self.batch_size)]
+            translated = dict()
+            failed_elements = self.translate_nss_batches(file_name, batches, translated, failure_log)
+            self.translate_nss_batches(file_name, [[pair] for pair in failed_elements], translated, failure_log)
+
+            collected_json = []
+            for index, element in to_translate:
+                if index in translated:
+                    # Extract the data.
+                    json_data = translated[index]
+                    json_data["text label"] = element["text label"]
+                    json_data["voice tag"] = element["voice tag"]
+                    json_data["Name"] = element["Name"]
+                    collected_json.append(json_data)
+            
+            file_json = {
+                "content": collected_json
+            }
+            # Dumb translated json to given location.
+            translated_json_file_path = os.path.join(self.raw_translate_loc, file_name)
+            VnTranslator.dump_json_dic_to_json_file(translated_json_file_path, file_json)
+
+
+    def translate_nss_batches(self, file_name, batches, translated, failure_log):
+        """
+        Translates batches of (index, nss json element) pairs concurrently, and stores the 
+        translated json of each element in translated, under its index.
+        Returns the pairs of the batches whose response could not be matched back to its elements,
+        failures of single element batches are added to failure_log instead.
+        """
+        # Responses keep the batch order.
+        responses = asyncio.run(self.do_with_texts([self.get_nss_translation_prompt(batch) for batch in batches]))
+
+        failed_elements = []
+        for batch, response in zip(batches, responses):
+            if isinstance(response, Exception):
+                failure = f"Translation request for element(s) from index: {batch[0][0]} of file: {file_name} failed " +\
+                f"with error: \n\n{response}\n\n"
+                print(failure)
+                if len(batch) == 1:
+                    failure_log.append(failure)
+                else:
+                    failed_elements.extend(batch)
+                continue
+
+            # Try to parse the JSON string from the response
+            json_data, failure = VnTranslator.loadJsonWithReTry(file_name, batch[0][0], response)
+
+            if len(batch) == 1:
+                if failure:
+                    # Log if parsing failed.
+                    failure_log.append(failure)
+                else:
+                    translated[batch[0][0]] = json_data
+            elif (not failure and isinstance(json_data, list) and len(json_data) == len(batch)
+                  and all(isinstance(ele, dict) for ele in json_data)):
+                for (index, _), ele in zip(batch, json_data):
+                    translated[index] = ele
+            else:
+                print(f"Batch translation for {file_name}, from element {batch[0][0]} failed! Retrying elements one by one...")
+                failed_elements.extend(batch)
+
+        return failed_elements
+
+
+    def get_nss_translation_prompt(self, batch):
+        """
+        Constructs the translation prompt for a batch of (index, nss json element) pairs,
+        a single element is sent as a json and several as a json array.
+        """
+        # Extract relevant portion for translation
+        if len(batch) == 1:
+            translation_json = {"text": batch[0][1]["text"]}
+            translation_instruction = VN_NSS_JSON_TRANSLATION_INSTRUCTION
+        else:
+            translation_json = [{"text": element["text"]} for _, element in batch]
+            translation_instruction = VN_NSS_JSON_BATCH_TRANSLATION_INSTRUCTION
+
+        # Convert into string.
+        str_json = VnTranslator.dumps_json_bytes(translation_json, indent=False).decode('utf-8')
+        return self.get_translate_with_glossary_prompt(str_json, translation_instruction=translation_instruction)
 
 
     def create_raw_translation_ln(self):
@@ -264,13 +366,9 @@ class VnTranslator:
         mode cohesive data that can be read like a normal chapter.
         """
         cleaned_translation = []
-        with open(self.raw_translate_loc, 'r', encoding='utf-8') as file:
-            content = file.read()
-            translated_block = re.findall(r'"translation":(.*?)}', content, re.DOTALL)
-
-            for block in translated_block:
-                print(block)
-                # TODO: Further cleaning steps comes here
+        for block in VnTranslator.iter_file_matches(self.raw_translate_loc, TRANSLATION_RE_B):
+            print(block)
+            # TODO: Further cleaning steps comes here
 
 
     def get_translate_with_glossary_prompt(self, chunk, translation_instruction=LN_TRANSLATION_INSTRUCTIONS):
@@ -278,12 +376,15 @@ class VnTranslator:
         A simple function, that goes through the input chunk, filters out glossary based on the chunk
         and constructs a prompt along with the filtered glossary, for LLM to translate.
         """
-        glossary_to_include = dict()
-        for key in self.loaded_glossary.keys():
-            if key in chunk:
-                glossary_to_include[key] = self.loaded_glossary[key]
+        if self.glossary_automaton is not None:
+            glossary_to_include = {key: value for _, (key, value) in self.glossary_automaton.iter(chunk)}
+        else:
+            glossary_to_include = dict()
+            for key in self.loaded_glossary.keys():
+                if key in chunk:
+                    glossary_to_include[key] = self.loaded_glossary[key]
         
-        glossary_to_include = json.dumps(glossary_to_include, ensure_ascii=False)
+        glossary_to_include = VnTranslator.dumps_json_bytes(glossary_to_include, indent=False).decode('utf-8')
         prompt = f"{VnTranslator.get_instruction_prompt(CHECK_GLOSSARY, glossary_to_include)}\n{VnTranslator.get_instruction_prompt(translation_instruction, chunk)}"
         return prompt
     
@@ -294,13 +395,52 @@ class VnTranslator:
         Dumb a dictionary into a JSON file.
         """
         try:
-            with open(out_path, 'w', encoding='utf-8') as json_file:
-                json.dump(json_dic, json_file, ensure_ascii=False, indent=4)
+            with open(out_path, 'wb') as json_file:
+                json_file.write(VnTranslator.dumps_json_bytes(json_dic))
             print(f"Content saved to {out_path}")
         except Exception as e:
             print(f"Error saving content to {json_dic}: {e}")
     
 
+    @staticmethod
+    def dumps_json_bytes(obj, indent=True):
+        """
+        Gives the JSON of an object as bytes, ready to be written to a file opened in 'wb' mode.
+        Pretty printed by default, pass indent=False when it only goes into a prompt.
+        """
+        if orjson is not None:
+            return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else None)
+        if indent:
+            return json.dumps(obj, ensure_ascii=False, indent=2).encode('utf-8')
+        return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+    @staticmethod
+    def loads_json(json_str):
+        """
+        Parses a JSON str or UTF-8 bytes, uses orjson when it is installed.
+        Raises a ValueError (json.JSONDecodeError) on invalid JSON either way.
+        """
+        if orjson is not None:
+            return orjson.loads(json_str)
+        return json.loads(json_str)
+
+
+    @staticmethod
+    def iter_file_matches(file_path, pattern):
+        """
+        Memory maps a UTF-8 file and yields the first group of each match of 
+        the bytes pattern, decoded, without reading the whole file into memory.
+        """
+        with open(file_path, 'rb') as file:
+            # Empty files cannot be mapped, and have no matches anyway.
+            if os.fstat(file.fileno()).st_size == 0:
+                return
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                for match in pattern.finditer(mm):
+                    yield match.group(1).decode('utf-8')
+
+
     @staticmethod
     def extract_json_from_text(input_file, out_json_file, error_log_file):
         """
@@ -310,28 +450,23 @@ class VnTranslator:
         combined_list = []
         failure_log = []
 
-        with open(input_file, 'r', encoding='utf-8') as file:
-            content = file.read()
+        # Extract JSON markdown content
+        for index, block in enumerate(VnTranslator.iter_file_matches(input_file, JSON_BLOCK_RE_B)):
 
-            # Extract JSON markdown content
-            json_blocks = re.findall(r'```json(.*?)```', content, re.DOTALL)
+            # Try to load it as json data
+            json_data, failure = VnTranslator.loadJsonWithReTry(input_file, index, block)
 
-            for index, block in enumerate(json_blocks):
+            if failure:
+                # Log if it failed.
+                failure_log.append(failure)
+                continue
+            else:
+                # Add to JSON to write.
+                combined_list.append(json_data)
 
-                # Try to load it as json data
-                json_data, failure = VnTranslator.loadJsonWithReTry(file.name, index, block)
-
-                if failure:
-                    # Log if it failed.
-                    failure_log.append(failure)
-                    continue
-                else:
-                    # Add to JSON to write.
-                    combined_list.append(json_data)
-
-        # Write the JSON content to given path
-        with open(out_json_file, 'w', encoding='utf-8') as output_file: 
-            json.dump(combined_list, output_file, indent=4, ensure_ascii=False)
+        # Write the JSON content to given path, compact since it is only an intermediate file
+        with open(out_json_file, 'wb') as output_file: 
+            output_file.write(VnTranslator.dumps_json_bytes(combined_list, indent=False))
 
         # Log failures to a file.
         if failure_log:
@@ -340,17 +475,28 @@ class VnTranslator:
 
     
     @staticmethod
-    def loadJsonWithReTry(file_name, json_index, json_str):
+    def extract_json_block(text):
+        """
+        Returns the content of the first ```json``` block in the text,
+        or the text itself if there is no such block.
+        """
+        match = JSON_BLOCK_RE.search(text)
+        return match.group(1) if match else text
+
+
+    @staticmethod
+    def loadJsonWithReTry(file_name, json_index, response):
         """
-        This method, tries to load a json string as a dictionary object,
-        if it fails, it tries to use LLM to fix it, and if it fails again,
-        returns a failure message.
+        This method, tries to load the (first) ```json``` block of an LLM response,
+        or a bare json string, as a dictionary object, if it fails, it tries to use 
+        LLM to fix it, and if it fails again, returns a failure message.
         """
         json_data = None
         failure = None
+        json_str = VnTranslator.extract_json_block(response)
         try:
             # Try to load the JSON
-            json_data = json.loads(json_str.strip())
+            json_data = VnTranslator.loads_json(json_str.strip())
         except Exception as e:
             print(f"JSON extraction for {file_name}, for element {json_index} failed! Attempting fix...")
 
@@ -360,8 +506,8 @@ class VnTranslator:
             response = VnTranslator.do_with_text(prompt)
             try:
                 # Extract content from JSON markdown and try loading again.
-                json_str = re.findall(r'```json(.*?)```', response, re.DOTALL)[0]
-                json_data = json.loads(json_str.strip())
+                json_str = VnTranslator.extract_json_block(response)
+                json_data = VnTranslator.loads_json(json_str.strip())
                 print("Success, issue resolved.")
             except Exception as e:
                 # Add failure message if required.
@@ -379,13 +525,32 @@ class VnTranslator:
         return FIX_JSON_PROMPT_TEMPLATE.format(incorrectJson, error)
     
 
+    @staticmethod
+    def iter_files(folder_path):
+        """
+        Goes through a folder and its sub folders, and yields a DirEntry for each file found.
+        """
+        try:
+            entries = os.scandir(folder_path)
+        except OSError:
+            # Unreadable folder, nothing to translate in it.
+            return
+        with entries:
+            for entry in entries:
+                # Symlinked folders are left out, they usually point back into the same tree.
+                if entry.is_dir(follow_symlinks=False):
+                    yield from VnTranslator.iter_files(entry.path)
+                elif entry.is_file():
+                    yield entry
+
+
     @staticmethod
     def read_nss_json_content(file_path):
         """
         Reads a JSON file and yields each element from the 'content' list as a JSON string.
         """
-        with open(file_path, 'r', encoding='utf-8') as file:
-            data = json.load(file)
+        with open(file_path, 'rb') as file:
+            data = VnTranslator.loads_json(file.read())
             for element in data.get('content', []):
                 yield element
 
@@ -396,12 +561,14 @@ class VnTranslator:
         Gives the content of a particular file as chunks.
         """
         # Use a compatible tokenizer for tokenization
-        tokenizer = tiktoken.get_encoding(encoding_name)
+        tokenizer = get_tokenizer(encoding_name)
         with open(file_path, 'r', encoding='utf-8') as file:
             text = file.read()
 
-        # Tokenize file content
-        tokens = tokenizer.encode(text)
+        # Tokenize file content, kept as a compact array of ints
+        # so each chunk below is a view rather than a copied list.
+        tokens = memoryview(array.array('I', tokenizer.encode(text)))
+        del text
 
         # Yields one chunk at a time.
         for i in range(0, len(tokens), tokens_per_chunk):
@@ -429,6 +596,30 @@ class VnTranslator:
         )
         return response["message"]["content"].strip()
 
+    async def do_with_texts(self, prompts, model=AYA_EXP, system_prompt=SYSTEM_PROMPT):
+        """
+        Runs several prompts on the OLLAMA server concurrently, with at most
+        max_concurrency requests in flight, and returns the responses in prompt order.
+        A request that fails gives its exception in place of the response, 
+        so one failure does not discard the other responses.
+        """
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        # The client is closed before the event loop of this run ends.
+        async with ollama.AsyncClient() as client:
+            async def do_one(prompt):
+                async with semaphore:
+                    response = await client.chat(
+                        model=model,
+                        messages=[
+                            {'role': 'system', 'content': system_prompt},
+                            {'role': 'user', 'content': prompt}
+                        ]
+                    )
+                return response["message"]["content"].strip()
+
+            return await asyncio.gather(*(do_one(prompt) for prompt in prompts), return_exceptions=True)
+
 
 # Example usage flow.
 NSS_INPUT_FOLDER = "nss/folder/input/path"